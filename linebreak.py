@@ -38,23 +38,42 @@ Reference:
 
 from __future__ import print_function
 
+import array
+import bisect
+import itertools
+import operator
 import sys
 
 __version__ = "1.01"
 
 INFINITY = 1000
 
+# Set this to True to trace the execution of the algorithm.  The tracing
+# code is compiled out entirely when running with python -O.
+DEBUG = False
+
 # Three classes defining the three different types of nides that
 # can go into an NodeList.
 
 
 class Item:
+    __slots__ = (
+        "width",
+        "stretch",
+        "shrink",
+        "penalty",
+        "flagged",
+        "ratio",
+    )
+
+    # The node type never changes, so it is a class attribute rather than a
+    # per-instance one.
+    is_box = is_glue = is_penalty = False
+
     def __init__(self, width=0, stretch=0, shrink=0, penalty=0, flagged=0):
         self.width, self.stretch, self.shrink = width, stretch, shrink
         self.penalty, self.flagged = penalty, flagged
         self.ratio = None
-        self.is_box = self.is_glue = self.is_penalty = False
-        self._forced_break = None
 
     def compute_width(self):
         r = self.ratio
@@ -68,47 +87,42 @@ class Item:
 
     @property
     def is_forced_break(self):
-        if self._forced_break is None:
-            self._forced_break = self.is_penalty and self.penalty == -INFINITY
-        return self._forced_break
+        return self.is_penalty and self.penalty == -INFINITY
 
 
 class Box(Item):
-    def __init__(self, **args):
-        super().__init__(**args)
-        self.is_box = True
+    __slots__ = ()
+
+    is_box = True
 
 
 class Glue(Item):
-    def __init__(self, **args):
-        super().__init__(**args)
-        self.is_glue = True
+    __slots__ = ()
+
+    is_glue = True
 
 
 class Penalty(Item):
-    def __init__(self, **args):
-        super().__init__(**args)
-        self.is_penalty = True
+    __slots__ = ()
+
+    is_penalty = True
 
 
 class _BreakNode:
     "Internal class representing an active breakpoint."
 
-    def __init__(
-        self,
-        position,
-        line,
-        fitness_class,
-        totalwidth,
-        totalstretch,
-        totalshrink,
-        demerits,
-        previous=None,
-    ):
+    __slots__ = (
+        "position",
+        "line",
+        "fitness_class",
+        "demerits",
+        "previous",
+    )
+
+    def __init__(self, position, line, fitness_class, demerits, previous=None):
         self.position, self.line = position, line
         self.fitness_class = fitness_class
-        self.totalwidth, self.totalstretch = totalwidth, totalstretch
-        self.totalshrink, self.demerits = totalshrink, demerits
+        self.demerits = demerits
         self.previous = previous
 
     def __repr__(self):
@@ -121,9 +135,6 @@ class NodeList(list):
     Supports the same methods as regular Python lists.
     """
 
-    # Set this to True to trace the execution of the algorithm.
-    debug = False
-
     def add_closing_penalty(self):
         "Add the standard glue and penalty for the end of a paragraph"
         self.append(Penalty(width=0, penalty=INFINITY, flagged=0))
@@ -161,7 +172,7 @@ class NodeList(list):
         length = self.measure_width(pos1, pos2)
         if self[pos2].is_penalty:
             length = length + self[pos2].width
-        if self.debug:
+        if __debug__ and DEBUG:
             print("\tline length=", length)
 
         # Get the length of the current line; if the line_lengths list
@@ -177,7 +188,7 @@ class NodeList(list):
         # stretched or shrunk to fit into the available space.
         if length < available_length:
             y = self.measure_stretch(pos1, pos2)
-            if self.debug:
+            if __debug__ and DEBUG:
                 print(
                     "\tLine too short: shortfall = %i, stretch = %i"
                     % (available_length - length, y)
@@ -189,7 +200,7 @@ class NodeList(list):
 
         elif length > available_length:
             z = self.measure_shrink(pos1, pos2)
-            if self.debug:
+            if __debug__ and DEBUG:
                 print(
                     "\tLine too long: extra = %s, shrink = %s"
                     % (available_length - length, z)
@@ -211,32 +222,30 @@ class NodeList(list):
         fitness_class) tuples has no repeated values.
         """
 
-        for node in nodes:
-            index = 0
+        keys = {(n.line, n.position, n.fitness_class) for n in active_nodes}
 
-            # Find the first index at which the active node's line number
-            # is equal to or greater than the line for 'node'.  This gives
-            # us the insertion point.
-            while index < len(active_nodes) and active_nodes[index].line < node.line:
-                index = index + 1
-
-            insert_index = index
+        # The line numbers of the active nodes, to binary search for the
+        # insertion point.
+        lines = [n.line for n in active_nodes]
 
+        for node in nodes:
             # Check if there's a node with the same line number and
             # position and fitness.  This lets us ensure that the list of
             # active nodes always has unique (line, position, fitness)
             # values.
-            while index < len(active_nodes) and active_nodes[index].line == node.line:
-                if (
-                    active_nodes[index].fitness_class == node.fitness_class
-                    and active_nodes[index].position == node.position
-                ):
-                    # A match, so just return without adding the node
-                    return
+            key = (node.line, node.position, node.fitness_class)
+            if key in keys:
+                # A match, so just return without adding the node
+                return
 
-                index = index + 1
+            # Find the first index at which the active node's line number
+            # is equal to or greater than the line for 'node'.  This gives
+            # us the insertion point.
+            index = bisect.bisect_left(lines, node.line)
 
-            active_nodes.insert(insert_index, node)
+            active_nodes.insert(index, node)
+            lines.insert(index, node.line)
+            keys.add(key)
 
     def compute_breakpoints(
         self,
@@ -272,39 +281,29 @@ class NodeList(list):
         if m == 0:
             return []  # No text, so no breaks
 
-        # Precompute lists containing the numeric values for each node.
-        # The variable names follow those in Knuth's description.
-        w = [0] * m
-        y = [0] * m
-        z = [0] * m
-        p = [0] * m
-        f = [0] * m
-        for i in range(m):
-            node = self[i]
-            w[i] = node.width
-            y[i] = node.stretch
-            z[i] = node.shrink
-            p[i] = node.penalty
-            f[i] = node.flagged
+        # Precompute arrays containing the numeric values for each node, so
+        # that the main loop below works on flat arrays instead of going
+        # through the node objects.  The variable names follow those in
+        # Knuth's description.
+        w = array.array("d", [node.width for node in self])
+        y = array.array("d", [node.stretch for node in self])
+        z = array.array("d", [node.shrink for node in self])
+        p = array.array("d", [node.penalty for node in self])
+        f = array.array("b", [node.flagged for node in self])
+        is_box = [node.is_box for node in self]
+        is_glue = [node.is_glue for node in self]
+        is_penalty = [node.is_penalty for node in self]
+        forced = [is_penalty[i] and p[i] == -INFINITY for i in range(m)]
 
         # Precompute the running sums of width, stretch, and shrink
         # (W,Y,Z in the original paper).  These make it easy to measure the
         # width/stretch/shrink between two indexes; just compute
         # sum_*[pos2] - sum_*[pos1].  Note that sum_*[i] is the total
-        # up to but not including the box at position i.
-        self.sum_width = {}
-        self.sum_stretch = {}
-        self.sum_shrink = {}
-        width_sum = stretch_sum = shrink_sum = 0
-        for i in range(m):
-            self.sum_width[i] = width_sum
-            self.sum_stretch[i] = stretch_sum
-            self.sum_shrink[i] = shrink_sum
-
-            node = self[i]
-            width_sum += node.width
-            stretch_sum += node.stretch
-            shrink_sum += node.shrink
+        # up to but not including the box at position i.  They are stored
+        # in lists, as they are indexed by position in the main loop.
+        sum_width = self.sum_width = list(itertools.accumulate(w, initial=0))
+        sum_stretch = self.sum_stretch = list(itertools.accumulate(y, initial=0))
+        sum_shrink = self.sum_shrink = list(itertools.accumulate(z, initial=0))
 
         # Initialize list of active nodes to a single break at the
         # beginning of the text.
@@ -312,124 +311,200 @@ class NodeList(list):
             position=0,
             line=0,
             fitness_class=1,
-            totalwidth=0,
-            totalstretch=0,
-            totalshrink=0,
             demerits=0,
         )
         active_nodes = [A]
 
-        if self.debug:
+        if __debug__ and DEBUG:
             print("Looping over %i nodes" % m)
 
-        for i in range(m):
-            B = self[i]
-            # Determine if this box is a feasible breakpoint and
-            # perform the main loop if it is.
-            if self.is_feasible_breakpoint(i):
-                if self.debug:
-                    print("Feasible breakpoint at %i:" % i)
-                    print("\tCurrent active node list:", active_nodes)
-
-                    # Print the list of active nodes, sorting them
-                    # so they can be visually checked for uniqueness.
-                    def key_f(n):
-                        return (n.line, n.position, n.fitness_class)
-
-                    active_nodes.sort(key=key_f)
-                    for A in active_nodes:
-                        print(A.position, A.line, A.fitness_class)
-                    print
-                    print
-
-                # Loop over the list of active nodes, and compute the fitness
-                # of the line formed by breaking at A and B.  The resulting
-                breaks = []  # List of feasible breaks
-                for A in active_nodes[:]:
-                    r = self.compute_adjustment_ratio(
-                        A.position, i, A.line, line_lengths
-                    )
-                    if self.debug:
-                        print("\tr=", r)
-                        print("\tline=", A.line)
-
-                    # XXX is 'or' really correct here?  This seems to
-                    # remove all active nodes on encountering a forced break!
-                    if r < -1 or B.is_forced_break:
-                        # Deactivate node A
-                        if len(active_nodes) == 1:
-                            if self.debug:
-                                print("Can't remove last node!")
-                                # XXX how should this be handled?
-                                # Raise an exception?
-                        else:
-                            if self.debug:
-                                print("\tRemoving node", A)
-                            active_nodes.remove(A)
-
-                    if -1 <= r <= tolerance:
-                        # Compute demerits and fitness class
-                        if p[i] >= 0:
-                            demerits = (1 + 100 * abs(r) ** 3 + p[i]) ** 3
-                        elif B.is_forced_break:
-                            demerits = (1 + 100 * abs(r) ** 3) ** 2 - p[i] ** 2
-                        else:
-                            demerits = (1 + 100 * abs(r) ** 3) ** 2
-
-                        demerits = demerits + (flagged_demerit * f[i] * f[A.position])
-
-                        # Figure out the fitness class of this line (tight, loose,
-                        # very tight or very loose).
-                        if r < -0.5:
-                            fitness_class = 0
-                        elif r <= 0.5:
-                            fitness_class = 1
-                        elif r <= 1:
-                            fitness_class = 2
-                        else:
-                            fitness_class = 3
-
-                        # If two consecutive lines are in very
-                        # different fitness classes, add to the
-                        # demerit score for this break.
-                        if abs(fitness_class - A.fitness_class) > 1:
-                            demerits = demerits + fitness_demerit
-
-                        if self.debug:
-                            print("\tDemerits=", demerits)
-                            print("\tFitness class=", fitness_class)
-
-                        # Record a feasible break from A to B
-                        brk = _BreakNode(
-                            position=i,
-                            line=A.line + 1,
-                            fitness_class=fitness_class,
-                            totalwidth=self.sum_width[i],
-                            totalstretch=self.sum_stretch[i],
-                            totalshrink=self.sum_shrink[i],
-                            demerits=demerits,
-                            previous=A,
+        # Only feasible breakpoints are looked at by the main loop, and
+        # whether a node is one depends only on the nodes themselves, so
+        # find them all up front.
+        feasible = [
+            i
+            for i in range(m)
+            if (is_penalty[i] and p[i] < INFINITY)
+            or (i > 0 and is_glue[i] and is_box[i - 1])
+        ]
+
+        # The last line length is used for all subsequent lines.  Repeat it
+        # so that there is an entry for every line a break can end, which
+        # is at most one line per feasible breakpoint, and the main loop
+        # can index the lengths directly.  In the common case of a single
+        # line length, this is simply that length for every line.
+        line_lengths = list(line_lengths)
+        line_lengths.extend(
+            [line_lengths[-1]] * (len(feasible) + 1 - len(line_lengths))
+        )
+
+        for i in feasible:
+            if __debug__ and DEBUG:
+                print("Feasible breakpoint at %i:" % i)
+                print("\tCurrent active node list:", active_nodes)
+
+                # Print the list of active nodes, sorting them
+                # so they can be visually checked for uniqueness.
+                def key_f(n):
+                    return (n.line, n.position, n.fitness_class)
+
+                active_nodes.sort(key=key_f)
+                for A in active_nodes:
+                    print(A.position, A.line, A.fitness_class)
+                print
+                print
+
+            # Loop over the list of active nodes, and compute the fitness
+            # of the line formed by breaking at A and B.  The resulting
+            breaks = []  # List of feasible breaks
+            deactivated = []  # Indices of active nodes to deactivate
+
+            # All breaks recorded here are at position i, which no active
+            # node is at yet, so a break can only duplicate (in line and
+            # fitness class) another break recorded here.  As in
+            # add_active_nodes(), no more breaks are recorded after the
+            # first duplicate.
+            break_keys = set()
+            duplicate = False
+
+            # Everything that only depends on B is the same for every active
+            # node, so read it once here.
+            width_i = sum_width[i]
+            stretch_i = sum_stretch[i]
+            shrink_i = sum_shrink[i]
+            break_width = w[i] if is_penalty[i] else 0
+            penalty_i = p[i]
+            forced_i = forced[i]
+            flagged_i = flagged_demerit * f[i]
+
+            for index, A in enumerate(active_nodes):
+                # Compute the adjustment ratio of the line from A to B;
+                # this is compute_adjustment_ratio() inlined, as calling
+                # it for every pair is a major cost of the main loop.
+                length = width_i - sum_width[A.position] + break_width
+                if __debug__ and DEBUG:
+                    print("\tline length=", length)
+
+                available_length = line_lengths[A.line]
+
+                if length < available_length:
+                    stretch = stretch_i - sum_stretch[A.position]
+                    if __debug__ and DEBUG:
+                        print(
+                            "\tLine too short: shortfall = %i, stretch = %i"
+                            % (available_length - length, stretch)
                         )
-                        breaks.append(brk)
-                        if self.debug:
-                            print("\tRecording feasible break", B)
-                            print("\t\tDemerits=", demerits)
-                            print("\t\tFitness class=", fitness_class)
-
-                # end for A in active_nodes
-                if breaks:
-                    if self.debug:
-                        print("List of breaks at ", i, ":", breaks)
-                    self.add_active_nodes(active_nodes, breaks)
-            # end if self.feasible_breakpoint()
-        # end for i in range(m)
-
-        if self.debug:
+                    if stretch > 0:
+                        r = (available_length - length) / stretch
+                    else:
+                        r = INFINITY
+                elif length > available_length:
+                    shrink = shrink_i - sum_shrink[A.position]
+                    if __debug__ and DEBUG:
+                        print(
+                            "\tLine too long: extra = %s, shrink = %s"
+                            % (available_length - length, shrink)
+                        )
+                    if shrink > 0:
+                        r = (available_length - length) / shrink
+                    else:
+                        r = INFINITY
+                else:
+                    r = 0
+
+                if __debug__ and DEBUG:
+                    print("\tr=", r)
+                    print("\tline=", A.line)
+
+                # XXX is 'or' really correct here?  This seems to
+                # remove all active nodes on encountering a forced break!
+                if r < -1 or forced_i:
+                    # Deactivate node A; it is removed from the list once
+                    # all active nodes have been checked.
+                    deactivated.append(index)
+
+                if -1 <= r <= tolerance and not duplicate:
+                    # Figure out the fitness class of this line (tight, loose,
+                    # very tight or very loose), i.e. 0 for r < -0.5, 1 for
+                    # -0.5 <= r <= 0.5, 2 for 0.5 < r <= 1 and 3 for r > 1.
+                    fitness_class = (r >= -0.5) + (r > 0.5) + (r > 1)
+
+                    key = (A.line, fitness_class)
+                    if key in break_keys:
+                        duplicate = True
+                        continue
+                    break_keys.add(key)
+
+                    # Compute demerits; the powers are spelled out as
+                    # products, which is cheaper than going through pow().
+                    ar = abs(r)
+                    base = 1 + 100 * ar * ar * ar
+                    if penalty_i >= 0:
+                        t = base + penalty_i
+                        demerits = t * t * t
+                    elif forced_i:
+                        demerits = base * base - penalty_i * penalty_i
+                    else:
+                        demerits = base * base
+
+                    demerits = demerits + (flagged_i * f[A.position])
+
+                    # If two consecutive lines are in very
+                    # different fitness classes, add to the
+                    # demerit score for this break.
+                    if abs(fitness_class - A.fitness_class) > 1:
+                        demerits = demerits + fitness_demerit
+
+                    if __debug__ and DEBUG:
+                        print("\tDemerits=", demerits)
+                        print("\tFitness class=", fitness_class)
+
+                    # Record a feasible break from A to B
+                    brk = _BreakNode(
+                        position=i,
+                        line=A.line + 1,
+                        fitness_class=fitness_class,
+                        demerits=demerits,
+                        previous=A,
+                    )
+                    breaks.append(brk)
+                    if __debug__ and DEBUG:
+                        print("\tRecording feasible break", self[i])
+                        print("\t\tDemerits=", demerits)
+                        print("\t\tFitness class=", fitness_class)
+
+            # end for A in active_nodes
+            if len(deactivated) == len(active_nodes):
+                # All nodes were deactivated, keep the last one.
+                if __debug__ and DEBUG:
+                    print("Can't remove last node!")
+                    # XXX how should this be handled?
+                    # Raise an exception?
+                deactivated.pop()
+            for index in reversed(deactivated):
+                A = active_nodes.pop(index)
+                if __debug__ and DEBUG:
+                    print("\tRemoving node", A)
+
+            if breaks:
+                if __debug__ and DEBUG:
+                    print("List of breaks at ", i, ":", breaks)
+
+                # Insert the new breaks, keeping the active list sorted by
+                # line number, see add_active_nodes().
+                lines = [n.line for n in active_nodes]
+                for brk in breaks:
+                    index = bisect.bisect_left(lines, brk.line)
+                    active_nodes.insert(index, brk)
+                    lines.insert(index, brk.line)
+        # end for i in feasible
+
+        if __debug__ and DEBUG:
             print("Main loop completed")
             print("Active nodes=", active_nodes)
 
         # Find the active node with the lowest number of demerits.
-        A = min(active_nodes, key=lambda A: A.demerits)
+        A = min(active_nodes, key=operator.attrgetter("demerits"))
 
         if looseness != 0:
             # The search for the appropriate active node is a bit more
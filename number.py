@@ -64,7 +64,7 @@ INDIVIDUALS = {
 900: 'تسعمائة',
 }
 
-def format_number(number, format_=0, feminine=0):
+def _format_number(number, format_=0, feminine=0):
     if not isinstance(number, int):
         raise ValueError
 
@@ -73,8 +73,8 @@ def format_number(number, format_=0, feminine=0):
     
     items = []
     if number > 99:
-        hundred = int(number / 100) * 100
-        number = number % 100
+        hundred, number = divmod(number, 100)
+        hundred *= 100
 
         if hundred == 200:
             items.append(INDIVIDUALS[hundred][format_])
@@ -85,8 +85,8 @@ def format_number(number, format_=0, feminine=0):
     elif number < 20:
         items.append(INDIVIDUALS[number][feminine])
     else:
-        ones = number % 10
-        tens = int(number / 10) * 10
+        tens, ones = divmod(number, 10)
+        tens *= 10
 
         items.append(INDIVIDUALS[tens][format_])
         if ones == 2:
@@ -96,3 +96,20 @@ def format_number(number, format_=0, feminine=0):
             items.append(INDIVIDUALS[ones][feminine])
 
     return ' و '.join(items)
+
+# The domain is small, so build the results for all valid inputs once.
+_FORMATTED = {
+    (number, format_, feminine): _format_number(number, format_, feminine)
+    for number in range(1, 1000)
+    for format_ in (0, 1)
+    for feminine in (0, 1)
+}
+
+def format_number(number, format_=0, feminine=0):
+    if not isinstance(number, int):
+        raise ValueError
+
+    try:
+        return _FORMATTED[number, format_, feminine]
+    except KeyError:
+        return _format_number(number, format_, feminine)
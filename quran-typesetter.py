@@ -1,5 +1,13 @@
+import array
+import bisect
+import concurrent.futures
+import itertools
 import logging
-import math
+import operator
+import os
+import pickle
+import re
+import sys
 import unicodedata
 
 import harfbuzz as hb
@@ -17,12 +25,18 @@ Q_STR = "\u06DE\u00A0"
 Q_PUA = 0x100000
 P_STR = "\u06E9"
 
+# Node kinds, see LineList.compute_breakpoints().
+BOX, GLUE, PENALTY = range(3)
+
+# Word separators, space and no-break space.
+SEP = re.compile("[ \u00A0]")
+
 
 class Document:
     """Class representing the main document and holding document-wide settings
     and state."""
 
-    def __init__(self, chapters, filename, decorations=True):
+    def __init__(self, chapters, filename, decorations=True, jobs=None, cache=None):
         logger.info("Initializing the document: %s", filename)
 
         # Settungs
@@ -41,16 +55,27 @@ class Document:
 
         self.page_decorations = decorations
 
-        # Cache for shaped words.
+        # Number of processes to break chapters into lines with, None means
+        # one per CPU.
+        self.jobs = jobs
+
+        # Cache for shaped words, and for the boxes holding them. The shaped
+        # words can also be kept in a file between runs.
         self.word_cache = {}
-        self.shaper = Shaper(self)
+        self.box_cache = {}
+        self.cache_file = cache
+
+        # Look the font up once, the shaper and Cairo get separate faces of it.
+        ft_face = ft.find_face(self.body_font)
+        self.shaper = Shaper(self, ft_face)
 
         self.surface = qh.PDFSurface.create(
             filename, (self.page_width, self.page_height)
         )
         # Create a new FreeType face for Cairo, as sometimes Cairo mangles the
         # char size, breaking HarfBuzz positions when it uses the same face.
-        ft_face = ft.find_face(self.body_font)
+        # The font file is known by now, so there is no need to match it again.
+        ft_face = ft.new_face(ft_face.filename, ft_face.face_index)
         cr = self.cr = qh.Context.create(self.surface)
         cr.set_font_face(qh.FontFace.create_for_ft_face(ft_face))
         cr.set_font_size(self.body_font_size)
@@ -63,8 +88,15 @@ class Document:
             line = -1
         return self.text_widths[line]
 
-    def get_page_number_pos(self, page, width):
-        pos = qh.Vector(0, self.page_number_ypos)
+    def get_page_number_pos(self, page, width, pos=None):
+        """
+        Returns the position of the page number, filling in the given vector
+        if any instead of creating a new one.
+        """
+
+        if pos is None:
+            pos = qh.Vector(0, 0)
+        pos.y = self.page_number_ypos
 
         # Center the number relative to the text box.
         line = self.lines_per_page - 1
@@ -83,19 +115,31 @@ class Document:
         else:
             return self.outer_margin + self.get_text_width(line)
 
-    def get_side_mark_pos(self, page, line, width):
+    def get_side_mark_pos(self, page, line, width, start=None):
+        """
+        Returns the x position of a side mark for the given line. start is
+        the start position of the line, if already known.
+        """
+
         x = self.outer_margin / 2 - width / 2
         if page.number % 2 == 0:
-            x += self.get_text_start_pos(page, line)
+            if start is None:
+                start = self.get_text_start_pos(page, line)
+            x += start
         return x
 
     def save(self):
         lines = self._create_lines()
         pages = self._create_pages(lines)
+        del lines
 
         logger.info("Drawing pages…")
         for page in pages:
             page.draw(self.cr)
+            # Drawn pages are not needed any more, let their lines go.
+            page.lines = None
+
+        self.shaper.save_cache()
 
         del self.cr
         del self.surface
@@ -105,9 +149,42 @@ class Document:
 
         logger.info("Breaking text into lines…")
 
-        lines = LineList(self)
+        # Shape all the words of the document up front, then build the
+        # paragraphs out of the cached words.
+        texts = []
         for chapter in self.chapters:
-            lines.extend(self._process_chapter(chapter))
+            texts.append(chapter.text)
+            texts.extend(chapter.get_heading_text())
+        self.shaper.shape_texts(texts)
+
+        paragraphs = [self.shaper.shape_paragraph(c.text) for c in self.chapters]
+
+        # Chapters are broken into lines independently of each other, so do it
+        # in parallel when there is more than one. The worker processes are
+        # sent plain copies of the nodes, as ours hold the document. Chapter
+        # lengths vary a lot, so the longest ones are started first to keep
+        # the workers busy until the end.
+        lengths = self.text_widths
+        if self.jobs == 1 or len(paragraphs) < 2:
+            results = map(_break_paragraph, paragraphs, itertools.repeat(lengths))
+        else:
+            order = sorted(
+                range(len(paragraphs)), key=lambda i: len(paragraphs[i]), reverse=True
+            )
+            with concurrent.futures.ProcessPoolExecutor(self.jobs) as executor:
+                futures = {
+                    i: executor.submit(
+                        _break_paragraph, _plain_nodes(paragraphs[i]), lengths
+                    )
+                    for i in order
+                }
+                results = [futures[i].result() for i in range(len(paragraphs))]
+
+        lines = LineList(self)
+        for chapter, nodes, (breaks, ratios) in zip(
+            self.chapters, paragraphs, results
+        ):
+            lines.extend(self._process_chapter(chapter, nodes, breaks, ratios))
 
         return lines
 
@@ -125,13 +202,20 @@ class Document:
         for i, breakpoint in enumerate(breaks[1:]):
             ratio = lines.compute_adjustment_ratio(start, breakpoint, i, lengths)
 
-            page = Page(self, [], len(pages) + 1)
-            for j in range(start, breakpoint):
-                line = lines[j]
-                if line.is_glue:
-                    line.ratio = ratio
-                    line.height = line.compute_width()
-                page.lines.append(line)
+            # Same as Glue.compute_width(), but the ratio is the same for
+            # the whole page so only look at its sign once. A page that fits
+            # exactly keeps the natural glue heights.
+            end = _strip_end(lines, start, breakpoint)
+            page = Page(self, lines[start:end], len(pages) + 1)
+            if ratio:
+                shrinking = ratio < 0
+                for line in page.lines:
+                    if line.is_glue:
+                        line.ratio = ratio
+                        if shrinking:
+                            line.height = line.width + ratio * line.shrink
+                        else:
+                            line.height = line.width + ratio * line.stretch
 
             pages.append(page)
             start = breakpoint + 1
@@ -146,34 +230,19 @@ class Document:
 
         return Heading(self, lines)
 
-    def _process_chapter(self, chapter):
-        """Shapes the text and breaks it into lines."""
+    def _process_chapter(self, chapter, nodes, breaks, ratios):
+        """Creates the lines of the shaped and broken chapter text."""
 
         logger.info("Chapter %d…", chapter.number)
 
-        lengths = self.text_widths
-        nodes = self.shaper.shape_paragraph(chapter.text)
-        breaks = nodes.compute_breakpoints(lengths, tolerance=4, looseness=10)
-        assert breaks[-1] == len(nodes) - 1
-
         lines = [self._create_heading(chapter)]
         if chapter.opening:
-            box = self.shaper.shape_word("\uFDFD")
-            lines.append(Line(self, [box]))
+            lines.append(Line(self, [self.shaper.opening]))
 
         start = 0
-        for i, breakpoint in enumerate(breaks[1:]):
-            ratio = nodes.compute_adjustment_ratio(start, breakpoint, i, lengths)
-
-            boxes = []
-            for j in range(start, breakpoint):
-                box = nodes[j]
-                if box.is_glue:
-                    box.ratio = ratio
-                    box.width = box.compute_width()
-                boxes.append(box)
-
-            lines.append(Line(self, boxes))
+        for breakpoint, ratio in zip(breaks[1:], ratios):
+            end = _strip_end(nodes, start, breakpoint)
+            lines.append(Line(self, nodes[start:end], ratio))
             lines.append(LineGlue(self))
 
             start = breakpoint + 1
@@ -195,63 +264,197 @@ class Chapter:
         self.opening = opening
         self.verses = verses
 
-    def get_heading_text(self):
-        text = []
-        number = format_number(self.number)
-        verses = format_number(self.verses)
-        text.append("(%s) سورة %s %s" % (number, self.name, self.place))
-        text.append("و آياتها %s" % verses)
+        number = format_number(number)
+        verses = format_number(verses)
+        self.heading_text = [
+            "(%s) سورة %s %s" % (number, name, place),
+            "و آياتها %s" % verses,
+        ]
 
-        return text
+    def get_heading_text(self):
+        return self.heading_text
 
 
 class Shaper:
     """Class for turning text into boxes and glue."""
 
-    def __init__(self, doc):
+    def __init__(self, doc, ft_face):
         self.doc = doc
-        ft_face = ft.find_face(doc.body_font)
         ft_face.set_char_size(size=doc.body_font_size, resolution=qh.base_dpi)
         self.font = hb.Font.ft_create(ft_face)
         self.buffer = hb.Buffer.create()
+        # clear_contents() keeps the cluster level, but resets direction,
+        # script and language, so only the former can be set once here.
+        self.buffer.cluster_level = (
+            hb.HARFBUZZ.BUFFER_CLUSTER_LEVEL_MONOTONE_CHARACTERS
+        )
+        self.language = hb.Language.from_string("ar")
+
+        # Shaping results are only valid for the same font file and size.
+        self.cache_key = None
+        if ft_face.filename is not None:
+            stat = os.stat(ft_face.filename)
+            self.cache_key = (
+                ft_face.filename,
+                stat.st_mtime_ns,
+                stat.st_size,
+                doc.body_font_size,
+            )
+        self.load_cache()
 
         # Get the natural space width
-        self.space = self.shape_word(" ").width
+        self.space = space = self.shape_word(" ").width
+
+        # The glue between words and the penalty for no-break spaces are never
+        # modified, so all paragraphs share the same ones.
+        self.glue = Glue(doc, space, space / 2, space / 1.5)
+        self.nbsp_penalty = Penalty(doc, 0, linebreak.INFINITY)
+
+        # Fixed margin labels, see Page._show_quarter().
+        self.labels = {
+            text: self.shape_word(text)
+            for text in ("سجدة", "ربع", "نصف", "ثلاثة أرباع", "الحزب", "حزب")
+        }
+
+        # The opening line of the chapters that have one.
+        self.opening = self.shape_word("\uFDFD")
+
+    def load_cache(self):
+        """Fills the word cache with the words shaped in a previous run."""
+
+        filename = self.doc.cache_file
+        if filename is None or self.cache_key is None:
+            return
+
+        try:
+            with open(filename, "rb") as f:
+                key, words = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning("Ignoring unreadable shaping cache %s: %s", filename, e)
+            return
+
+        if key != self.cache_key:
+            logger.info("Shaping cache is for another font, ignoring it")
+            return
+
+        logger.info("Loading %d shaped words from %s", len(words), filename)
+        cache = self.doc.word_cache
+        for text, (glyphs, width) in words.items():
+            glyphs = [qh.Glyph(index, qh.Vector(x, y)) for index, x, y in glyphs]
+            cache[text] = Word(text, glyphs, width)
+
+    def save_cache(self):
+        """Writes the word cache to the cache file, if any."""
+
+        filename = self.doc.cache_file
+        if filename is None or self.cache_key is None:
+            return
+
+        # Store plain tuples, so that the file does not depend on the classes.
+        words = {}
+        for text, word in self.doc.word_cache.items():
+            glyphs = [(g.index, g.pos.x, g.pos.y) for g in word.glyphs]
+            words[text] = (glyphs, word.width)
+
+        logger.info("Saving %d shaped words to %s", len(words), filename)
+        with open(filename, "wb") as f:
+            pickle.dump((self.cache_key, words), f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def get_direction(text):
+        # Everything is RTL except aya numbers and other digits-only words.
+        if text[0] in ("\u06DD", "(") or text.isdigit():
+            return hb.HARFBUZZ.DIRECTION_LTR
+        return hb.HARFBUZZ.DIRECTION_RTL
+
+    def shape(self, text, direction):
+        buf = self.buffer
+        buf.clear_contents()
+        buf.add_str(text)
+        buf.direction = direction
+        buf.script = hb.HARFBUZZ.SCRIPT_ARABIC
+        buf.language = self.language
+
+        hb.shape(self.font, buf)
+
+        return buf
+
+    def shape_words(self, words):
+        """
+        Shapes the given right-to-left words that are not cached yet and adds
+        them to the cache. Instead of shaping each word on its own, the words
+        are shaped in one go as a single space separated text, and the glyphs
+        are then split back into words using their clusters. Like with
+        shape_paragraph(), this relies on our font not doing anything special
+        around spaces.
+        """
+
+        cache = self.doc.word_cache
+        words = [w for w in dict.fromkeys(words) if w not in cache]
+        if not words:
+            return
+
+        # The offset of each word in the text.
+        starts = []
+        offset = 0
+        for word in words:
+            starts.append(offset)
+            offset += len(word) + 1
+
+        buf = self.shape(" ".join(words), hb.HARFBUZZ.DIRECTION_RTL)
+        infos = buf.glyph_infos
+        positions = buf.glyph_positions
+
+        # Collect the glyphs of each word, skipping the spaces.
+        runs = [[] for word in words]
+        for k, info in enumerate(infos):
+            index = bisect.bisect_right(starts, info.cluster) - 1
+            if info.cluster - starts[index] < len(words[index]):
+                runs[index].append(k)
+
+        # Position the glyphs of each word relative to its start, the same
+        # way Buffer.get_glyphs() does.
+        flip = qh.Vector(1, -1)
+        for word, run in zip(words, runs):
+            pos = qh.Vector(0, 0)
+            glyphs = []
+            for k in run:
+                glyphs.append(
+                    qh.Glyph(infos[k].codepoint, pos + flip * positions[k].offset)
+                )
+                pos += flip * positions[k].advance
+            cache[word] = Word(word, glyphs, pos.x)
 
     def shape_word(self, word):
         """
         Shapes a single word and returns the corresponding box. To speed things
-        a bit, we cache the shaped words. We assume all our text is in Arabic
-        script and language. The direction is almost always right-to-left,
-        (we are cheating a bit to avoid doing proper bidirectional text as
-        it is largely superfluous for us here).
+        a bit, we cache the shaped words and their boxes; boxes are not
+        modified after they are created, so they can be shared. We assume all
+        our text is in Arabic script and language. The direction is almost
+        always right-to-left, (we are cheating a bit to avoid doing proper
+        bidirectional text as it is largely superfluous for us here).
         """
 
         assert word
 
+        doc = self.doc
+        box = doc.box_cache.get(word)
+        if box is not None:
+            return box
+
         text = word
         if ord(word[0]) > Q_PUA:
             text = word[1:]
 
-        if text not in self.doc.word_cache:
-            self.buffer.clear_contents()
-            self.buffer.add_str(text)
-            # Everything is RTL except aya numbers and other digits-only words.
-            if text[0] in ("\u06DD", "(") or text.isdigit():
-                self.buffer.direction = hb.HARFBUZZ.DIRECTION_LTR
-            else:
-                self.buffer.direction = hb.HARFBUZZ.DIRECTION_RTL
-            self.buffer.script = hb.HARFBUZZ.SCRIPT_ARABIC
-            self.buffer.language = hb.Language.from_string("ar")
-            self.buffer.cluster_level = (
-                hb.HARFBUZZ.BUFFER_CLUSTER_LEVEL_MONOTONE_CHARACTERS
-            )
-
-            hb.shape(self.font, self.buffer)
+        shaped = doc.word_cache.get(text)
+        if shaped is None:
+            buf = self.shape(text, self.get_direction(text))
+            glyphs, pos = buf.get_glyphs()
+            shaped = doc.word_cache[text] = Word(text, glyphs, pos.x, buf)
 
-            self.doc.word_cache[text] = Word(text, self.buffer)
-
-        box = Box(self.doc, self.doc.word_cache[text])
+        box = Box(doc, shaped)
 
         # Flag boxes with “quarter” symbol, as it needs some special
         # handling later.
@@ -260,59 +463,125 @@ class Shaper:
         if word.startswith(P_STR):
             box.prostration = True
 
+        doc.box_cache[word] = box
+
         return box
 
+    def split_words(self, text):
+        """
+        Splits the text into words, treating space and no-break space as word
+        separators. Each word is paired with the separator following it, None
+        for the last one. Words are interned, as most of them repeat and the
+        caches can then match them by identity.
+        """
+
+        # Skip leading and trailing white space by searching between the
+        # first and last non-space characters, instead of stripping what can
+        # be a whole chapter into a new string.
+        start = 0
+        stop = len(text)
+        while start < stop and text[start].isspace():
+            start += 1
+        while stop > start and text[stop - 1].isspace():
+            stop -= 1
+
+        words = []
+        for match in SEP.finditer(text, start, stop):
+            ch = match.group()
+            end = match.end()
+            # No-break space before a combining mark is part of the word.
+            # The search stops at a non-space, so there is always a next one.
+            if ch == "\u00A0" and unicodedata.combining(text[end]):
+                continue
+            words.append((sys.intern(text[start : match.start()]), ch))
+            start = end
+        words.append((sys.intern(text[start:stop]), None))  # last word
+
+        return words
+
+    def _collect_words(self, words, texts):
+        """Adds the right-to-left words that need shaping to texts."""
+
+        boxes = self.doc.box_cache
+        for word, sep in words:
+            if word in boxes:
+                continue
+            if word and ord(word[0]) > Q_PUA:
+                word = word[1:]
+            if word and self.get_direction(word) == hb.HARFBUZZ.DIRECTION_RTL:
+                texts.append(word)
+
+    def shape_texts(self, texts):
+        """
+        Shapes the words of all the given texts in one go, so that the later
+        shape_paragraph() calls find them in the cache.
+        """
+
+        words = []
+        for text in texts:
+            self._collect_words(self.split_words(text), words)
+        self.shape_words(words)
+
     def shape_paragraph(self, text):
         """
         Converts the text to a list of boxes and glues that the line breaker
-        will work on. We basically split text into words and shape each word
-        separately then put it into a box. We don’t try to preserve the
-        context when shaping the words, as we know that our font does not
-        do anything special around spaces, which in turn allows us to cache
-        the shaped words.
+        will work on. We basically split text into words, shape the words not
+        seen before in one go, then put each word into a box. We don’t try to
+        preserve the context when shaping the words, as we know that our font
+        does not do anything special around spaces, which in turn allows us to
+        cache the shaped words.
         """
         nodes = linebreak.NodeList()
 
-        space = self.space
-
-        # Split the text into words, treating space, newline and no-break space
-        # as word separators.
-        word = ""
-        text = text.strip()
-        textlen = len(text)
-        for i, ch in enumerate(text):
-            if ch == "\u00A0" and unicodedata.combining(
-                text[i + 1] if i < textlen else ""
-            ):
-                word += ch
-            elif ch in (" ", "\u00A0"):
-                nodes.append(self.shape_word(word))
-
-                # Prohibit line breaking at no-break space.
-                if ch == "\u00A0":
-                    nodes.append(Penalty(self.doc, 0, linebreak.INFINITY))
-
-                nodes.append(Glue(self.doc, space, space / 2, space / 1.5))
-                word = ""
-            else:
-                word += ch
-        nodes.append(self.shape_word(word))  # last word
+        words = self.split_words(text)
+
+        # Shape all the right-to-left words at once, shape_word() will then
+        # find them in the cache.
+        texts = []
+        self._collect_words(words, texts)
+        self.shape_words(texts)
+
+        glue = self.glue
+        penalty = self.nbsp_penalty
+        shape = self.shape_word
+        append = nodes.append
+        for word, sep in words:
+            append(shape(word))
+            if sep is None:
+                break
+
+            # Prohibit line breaking at no-break space.
+            if sep == "\u00A0":
+                append(penalty)
+
+            append(glue)
 
         nodes.add_closing_penalty()
 
         return nodes
 
 
+# Maps ASCII digits to Arabic-Indic ones.
+DIGITS = str.maketrans("0123456789", "٠١٢٣٤٥٦٧٨٩")
+
+# Formatted numbers covering all page, chapter and verse numbers.
+NUMBERS = [str(number).translate(DIGITS) for number in range(1000)]
+
+
 def format_number(number):
     """Format number to Arabic-Indic digits."""
 
     number = int(number)
-    return "".join([chr(ord(c) + 0x0630) for c in str(number)])
+    if 0 <= number < len(NUMBERS):
+        return NUMBERS[number]
+    return str(number).translate(DIGITS)
 
 
 class Page:
     """Class representing a page of text."""
 
+    __slots__ = ("doc", "lines", "number")
+
     def __init__(self, doc, lines, number):
         self.doc = doc
         self.lines = lines
@@ -322,7 +591,6 @@ class Page:
         logger.info("Page %d…", self.number)
 
         shaper = self.doc.shaper
-        self.cr = cr
 
         if not self.lines:
             logger.debug("Leaving empty page blank")
@@ -331,21 +599,29 @@ class Page:
 
         self.strip()
 
+        doc = self.doc
         lines = self.lines
-        pos = qh.Vector(0, self.doc.top_margin)
+        pos = qh.Vector(0, doc.top_margin)
+
+        # All lines have the same width unless more than one width is given.
+        varying = len(doc.text_widths) > 1
+        start = doc.get_text_start_pos(self, 0)
+        text_width = doc.get_text_width(0)
         for i, line in enumerate(lines):
-            pos.x = self.doc.get_text_start_pos(self, i)
-            text_width = self.doc.get_text_width(i)
+            if varying:
+                start = doc.get_text_start_pos(self, i)
+                text_width = doc.get_text_width(i)
+            pos.x = start
             line.draw(cr, pos, text_width)
-            if line.get_quarter() or line.get_prostration():
-                self._show_quarter(
-                    line, line.get_quarter(), line.get_prostration(), pos.y
-                )
+            quarter = line.get_quarter()
+            prostration = line.get_prostration()
+            if quarter or prostration:
+                self._show_quarter(cr, i, quarter, prostration, pos.y, start)
             pos.y += line.height
 
         # Show page number.
         box = shaper.shape_word(format_number(self.number))
-        pos = self.doc.get_page_number_pos(self, box.width)
+        self.doc.get_page_number_pos(self, box.width, pos)
         box.draw(cr, pos)
 
         # Draw page decorations.
@@ -368,7 +644,7 @@ class Page:
 
         cr.show_page()
 
-    def _show_quarter(self, line, quarter, prostration, y):
+    def _show_quarter(self, cr, line, quarter, prostration, y, start=None):
         """
         Draw the quarter, group and part text on the margin. A group is 4
         quarters, a part is 2 groups.
@@ -380,23 +656,24 @@ class Page:
             logger.debug("Prostration at page %d", self.number)
 
         shaper = self.doc.shaper
+        labels = shaper.labels
 
         boxes = []
         if prostration:
-            boxes.append(shaper.shape_word("سجدة"))
+            boxes.append(labels["سجدة"])
         if quarter:
             num = quarter % 4
             if num:
                 # A quarter.
                 words = ("ربع", "نصف", "ثلاثة أرباع")
-                boxes.append(shaper.shape_word(words[num - 1]))
-                boxes.append(shaper.shape_word("الحزب"))
+                boxes.append(labels[words[num - 1]])
+                boxes.append(labels["الحزب"])
             else:
                 # A group…
                 group = format_number(quarter / 4 + 1)
                 if quarter % 8:
                     # … without a part.
-                    boxes.append(shaper.shape_word("حزب"))
+                    boxes.append(labels["حزب"])
                     boxes.append(shaper.shape_word(group))
                 else:
                     # … with a part.
@@ -410,23 +687,29 @@ class Page:
         # … and the leading to be tighter.
         leading = self.doc.body_font_size
 
-        w = max([box.width for box in boxes])
+        w = max(box.width for box in boxes)
         h = leading * len(boxes)
-        x = self.doc.get_side_mark_pos(self, line, w)
+        x = self.doc.get_side_mark_pos(self, line, w, start)
         # Center the boxes vertically around the line.
         y -= h * scale / 2
+
+        # Scale once for all the boxes, so their positions are divided by the
+        # scale to end up in the same place.
+        glyphs = []
         for box in boxes:
             # Center the box horizontally relative to the others
             offset = (w - box.width) * scale / 2
 
-            self.cr.save()
-            self.cr.translate((x + offset, y))
-            self.cr.scale((scale, scale))
-            self.cr.show_glyphs(box.word.glyphs)
-            self.cr.restore()
+            pos = qh.Vector((x + offset) / scale, y / scale)
+            glyphs.extend(qh.offset_glyphs(box.word.glyphs, pos))
 
             y += leading
 
+        cr.save()
+        cr.scale((scale, scale))
+        cr.show_glyphs(glyphs)
+        cr.restore()
+
     def strip(self):
         while not self.lines[-1].is_box:
             self.lines.pop()
@@ -435,12 +718,12 @@ class Page:
 class Word:
     """Class representing a shaped word."""
 
-    def __init__(self, text, buf):
-        self.text = text
+    __slots__ = ("text", "glyphs", "width", "backward", "clusters")
 
-        glyphs, pos = buf.get_glyphs()
+    def __init__(self, text, glyphs, width, buf=None):
+        self.text = text
         self.glyphs = glyphs
-        self.width = pos.x
+        self.width = width
 
         if False:
             # Do clusters per glyph/charcter, disabled for now as it does not
@@ -474,55 +757,120 @@ class Word:
             self.clusters = [(len(text), len(glyphs))]
 
 
+def _strip_end(nodes, start, end):
+    """Returns the end of nodes[start:end] without its trailing non-boxes."""
+
+    while end > start and not nodes[end - 1].is_box:
+        end -= 1
+    return end
+
+
+def _plain_nodes(nodes):
+    """Returns a copy of the nodes made only of the base linebreak types."""
+
+    plain = linebreak.NodeList()
+    for node in nodes:
+        if node.is_box:
+            cls = linebreak.Box
+        elif node.is_glue:
+            cls = linebreak.Glue
+        else:
+            cls = linebreak.Penalty
+        plain.append(
+            cls(
+                width=node.width,
+                stretch=node.stretch,
+                shrink=node.shrink,
+                penalty=node.penalty,
+                flagged=node.flagged,
+            )
+        )
+    return plain
+
+
+def _break_paragraph(nodes, line_lengths):
+    """
+    Breaks the nodes of a chapter into lines, returning the breakpoints and
+    the adjustment ratio of each line.
+    """
+
+    breaks = nodes.compute_breakpoints(line_lengths, tolerance=4, looseness=10)
+    assert breaks[-1] == len(nodes) - 1
+
+    ratios = []
+    start = 0
+    for i, breakpoint in enumerate(breaks[1:]):
+        ratios.append(
+            nodes.compute_adjustment_ratio(start, breakpoint, i, line_lengths)
+        )
+        start = breakpoint + 1
+
+    return breaks, ratios
+
+
+def _break_pages(kinds, heights, line_lengths):
+    """
+    Calculates the page breaks, given the kind and height of each line and
+    glue. This only works on flat arrays of numbers, so that it stays a tight
+    loop.
+    """
+
+    # XXX: This seems rather hackish, clean it up!
+    breaks = [0]
+    height = 0
+    last = 0
+    i = 0
+    count = len(kinds)
+    lengths_count = len(line_lengths)
+    while i < count:
+        line = len(breaks)
+        length = line_lengths[line if line < lengths_count else -1]
+
+        kind = kinds[i]
+        if kind != PENALTY:
+            height += heights[i]
+
+        if kind != BOX:
+            if height > length:
+                breaks.append(last)
+                height = 0
+                i = last
+            elif height == length:
+                breaks.append(i)
+                height = 0
+            else:
+                last = i
+        i += 1
+
+    if breaks[-1] != count - 1:
+        breaks.append(count - 1)
+
+    return breaks
+
+
 class LineList(linebreak.NodeList):
     def __init__(self, doc):
         super().__init__()
         self.doc = doc
 
     def compute_breakpoints(self, line_lengths):
-        # Copied from compute_breakpoints() since compute_adjustment_ratio()
-        # needs them.
-        self.sum_width = {}
-        self.sum_shrink = {}
-        self.sum_stretch = {}
-        width_sum = shrink_sum = stretch_sum = 0
-        for i, node in enumerate(self):
-            self.sum_width[i] = width_sum
-            self.sum_shrink[i] = shrink_sum
-            self.sum_stretch[i] = stretch_sum
-
-            width_sum += node.height
-            shrink_sum += node.shrink
-            stretch_sum += node.stretch
-
-        # Calculate line breaks.
-        # XXX: This seems rather hackish, clean it up!
-        breaks = [0]
-        height = 0
-        last = 0
-        i = 0
-        while i < len(self):
-            line = len(breaks)
-            length = line_lengths[line if line < len(line_lengths) else -1]
-
-            node = self[i]
-            if node.is_box or node.is_glue:
-                height += node.height
-
-            if not node.is_box:
-                if height > length:
-                    breaks.append(last)
-                    height = 0
-                    i = last
-                elif height == length:
-                    breaks.append(i)
-                    height = 0
-                else:
-                    last = i
-            i += 1
+        # Like compute_breakpoints(), since compute_adjustment_ratio() needs
+        # them, but using heights instead of widths. The values are kept in
+        # flat arrays, one per attribute, so that the scan below does not have
+        # to go through the node objects.
+        heights = array.array("d", [node.height for node in self])
+        shrinks = array.array("d", [node.shrink for node in self])
+        stretches = array.array("d", [node.stretch for node in self])
+        kinds = array.array(
+            "b", [BOX if n.is_box else GLUE if n.is_glue else PENALTY for n in self]
+        )
+        self.sum_width = array.array("d", itertools.accumulate(heights, initial=0))
+        self.sum_shrink = array.array("d", itertools.accumulate(shrinks, initial=0))
+        self.sum_stretch = array.array(
+            "d", itertools.accumulate(stretches, initial=0)
+        )
 
-        if breaks[-1] != len(self) - 1:
-            breaks.append(len(self) - 1)
+        breaks = _break_pages(kinds, heights, line_lengths)
 
         # Check that we are not overflowing the page, i.e. we don’t have more
         # lines per page (plus intervening glue) than we should.
@@ -537,6 +885,8 @@ class LineList(linebreak.NodeList):
 class Glue(linebreak.Glue):
     """Wrapper around linebreak.Glue to hold our common API."""
 
+    __slots__ = ("doc",)
+
     def __init__(self, doc, width, stretch, shrink):
         super().__init__(width=width, stretch=stretch, shrink=shrink)
         self.doc = doc
@@ -554,6 +904,8 @@ class Glue(linebreak.Glue):
 class Penalty(linebreak.Penalty):
     """Wrapper around linebreak.Penalty to hold our common API."""
 
+    __slots__ = ("doc",)
+
     def __init__(self, doc, width, penalty, flagged=0):
         super().__init__(width=width, penalty=penalty, flagged=flagged)
         self.doc = doc
@@ -571,6 +923,8 @@ class Penalty(linebreak.Penalty):
 class Box(linebreak.Box):
     """Class representing a word."""
 
+    __slots__ = ("doc", "word", "quarter", "prostration")
+
     def __init__(self, doc, word):
         super().__init__(width=word.width)
         self.doc = doc
@@ -585,18 +939,19 @@ class Box(linebreak.Box):
         return self.prostration
 
     def draw(self, cr, pos, text_width=0):
-        cr.save()
-        cr.translate(pos)
         word = self.word
         if word.backward:
             flags = qh.CAIRO.TEXT_CLUSTER_FLAG_BACKWARD
         else:
             flags = 0
-        cr.show_text_glyphs(word.text, word.glyphs, word.clusters, flags)
-        cr.restore()
+        # Position the glyphs directly rather than translating the context.
+        glyphs = list(qh.offset_glyphs(word.glyphs, pos))
+        cr.show_text_glyphs(word.text, glyphs, word.clusters, flags)
 
 
 class LineGlue(Glue):
+    __slots__ = ("height",)
+
     def __init__(self, doc, height=0, stretch=0, shrink=0):
         super().__init__(doc, width=height, stretch=stretch, shrink=shrink)
         self.height = self.width
@@ -605,37 +960,90 @@ class LineGlue(Glue):
 class Line(linebreak.Box):
     """Class representing a line of text."""
 
-    def __init__(self, doc, boxes):
+    __slots__ = ("doc", "height", "boxes", "quarter", "prostration")
+
+    def __init__(self, doc, boxes, ratio=None):
         super().__init__(width=doc.leading)
         self.doc = doc
         self.height = self.width
         self.boxes = boxes
+        # The adjustment ratio of the glue in this line. The glue is shared
+        # between lines, so its width is adjusted when drawing instead of
+        # being stored in it.
+        self.ratio = ratio
+
+        # The boxes do not change after this, so look these up once. Only
+        # boxes can carry them, glue and penalties never do.
+        self.quarter = 0
+        self.prostration = False
+        for box in boxes:
+            if box.is_box:
+                self.quarter = self.quarter or box.get_quarter()
+                self.prostration = self.prostration or box.get_prostration()
 
     def get_quarter(self):
-        for box in self.boxes:
-            if box.get_quarter():
-                return box.get_quarter()
-        return 0
+        return self.quarter
 
     def get_prostration(self):
-        for box in self.boxes:
-            if box.get_prostration():
-                return box.get_prostration()
-        return False
+        return self.prostration
 
     def draw(self, cr, pos, text_width):
         self.strip()
-        width = sum([box.width for box in self.boxes])
-        # Center lines not equal to text width.
-        if not math.isclose(width, text_width):
-            pos.x -= (text_width - width) / 2
-
-        for box in self.boxes:
-            # We start drawing from the right edge of the text block,
-            # and move to the left, thus the subtraction instead of
-            # addition below.
-            pos.x -= box.width
-            box.draw(cr, pos)
+        boxes = self.boxes
+        ratio = self.ratio
+        # Adjust the glue the same way Glue.compute_width() does, unless the
+        # line fits exactly.
+        if not ratio:
+            widths = [box.width for box in boxes]
+        elif ratio < 0:
+            widths = [
+                box.width + ratio * box.shrink if box.is_glue else box.width
+                for box in boxes
+            ]
+        else:
+            widths = [
+                box.width + ratio * box.stretch if box.is_glue else box.width
+                for box in boxes
+            ]
+        width = sum(widths)
+        x = pos.x
+        # Center lines not equal to text width. This is math.isclose() with
+        # its default relative tolerance, spelled out to save the call.
+        diff = text_width - width
+        if abs(diff) > 1e-09 * max(abs(width), abs(text_width)):
+            x -= diff / 2
+
+        # We start drawing from the right edge of the text block, and move to
+        # the left, so each box is drawn at the running difference of the
+        # widths before it and its own.
+        xs = itertools.accumulate(widths, operator.sub, initial=x)
+        next(xs)
+
+        if any(box.is_box and box.word.backward for box in boxes):
+            for box, x in zip(boxes, xs):
+                pos.x = x
+                box.draw(cr, pos)
+            return
+
+        # Draw the whole line at once, offsetting each word’s glyphs by its
+        # position instead of moving the origin for every box.
+        text = []
+        glyphs = []
+        clusters = []
+        y = pos.y
+        for box, x in zip(boxes, xs):
+            if box.is_box:
+                word = box.word
+                text.append(word.text)
+                glyphs.extend(qh.offset_glyphs(word.glyphs, qh.Vector(x, y)))
+                clusters.extend(word.clusters)
+            elif box.is_glue:
+                # Keep the word space in the text, it has no glyphs.
+                text.append(" ")
+                clusters.append((1, 0))
+        pos.x = x
+
+        cr.show_text_glyphs("".join(text), glyphs, clusters, 0)
 
     def strip(self):
         while not self.boxes[-1].is_box:
@@ -645,6 +1053,8 @@ class Line(linebreak.Box):
 class Heading(Line):
     """Class representing a chapter heading."""
 
+    __slots__ = ()
+
     def __init__(self, doc, lines):
         super().__init__(doc, lines)
         self.height = doc.leading * 1.8
@@ -708,8 +1118,8 @@ def read_data(datadir):
     return chapters
 
 
-def main(chapters, filename, decorations):
-    document = Document(chapters, filename, decorations)
+def main(chapters, filename, decorations, jobs=None, cache=None):
+    document = Document(chapters, filename, decorations, jobs, cache)
     document.save()
 
 
@@ -740,6 +1150,18 @@ if __name__ == "__main__":
         dest="decorations",
         help="Don’t draw page decorations",
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        metavar="N",
+        type=int,
+        help="Number of processes for line breaking (Default: one per CPU)",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="FILE",
+        help="File to keep shaped words in between runs (Default: none)",
+    )
     parser.add_argument(
         "--quite", "-q", action="store_true", help="Don’t print normal messages"
     )
@@ -762,4 +1184,4 @@ if __name__ == "__main__":
     for i in args.chapters:
         chapters.append(all_chapters[i - 1])
 
-    main(chapters, args.outfile, args.decorations)
+    main(chapters, args.outfile, args.decorations, args.jobs, args.cache)
@@ -1,6 +1,10 @@
+import concurrent.futures
+import copy
+import itertools
 import logging
 import math
 import os
+import re
 import unicodedata
 
 import harfbuzz as hb
@@ -17,7 +21,10 @@ logger = logging.getLogger("typesetter")
 logger.setLevel(logging.INFO)
 
 DIGITS = ("٠", "١", "٢", "٣", "٤", "٥", "٦", "٧", "٨", "٩")
-RIGH_JOINING = ("ا", "آ", "أ", "إ", "د", "ذ", "ر", "ز", "و", "ؤ")
+RIGH_JOINING = frozenset(("ا", "آ", "أ", "إ", "د", "ذ", "ر", "ز", "و", "ؤ"))
+
+# Aya mark and the verse number following it.
+AYA_MARK = re.compile("(\u06DD[" + "".join(DIGITS) + "]*)")
 
 GID_OFFSET = 0x10FFFF
 
@@ -29,10 +36,11 @@ class Document:
     """Class representing the main document and holding document-wide settings
     and state."""
 
-    def __init__(self, chapters, filename, debug):
+    def __init__(self, chapters, filename, debug, jobs=None):
         logger.info("Initializing the document: %s", filename)
 
         self.debug = debug
+        self.jobs = jobs
 
         # Settings
         # The defaults here roughly match “the 12-lines Mushaf”.
@@ -48,6 +56,9 @@ class Document:
 
         self.text_start_pos = self.text_width + (self.page_width - self.text_width) / 2
 
+        # All lines have the same length.
+        self.line_lengths = [self.text_width]
+
         self.shaper = Shaper(self)
 
         self.surface = qh.PDFSurface.create(
@@ -76,9 +87,34 @@ class Document:
 
         logger.info("Breaking text into lines…")
 
+        paragraphs = [self._shape_chapter(chapter) for chapter in self.chapters]
+
+        # Chapters are broken into lines independently of each other, so do it
+        # in parallel when there is more than one. The worker processes are
+        # sent plain copies of the nodes, as ours hold the document. Chapter
+        # lengths vary a lot, so the longest ones are started first to keep
+        # the workers busy until the end.
+        lengths = self.line_lengths
+        if self.jobs == 1 or len(paragraphs) < 2:
+            results = map(_break_paragraph, paragraphs, itertools.repeat(lengths))
+        else:
+            order = sorted(
+                range(len(paragraphs)), key=lambda i: len(paragraphs[i]), reverse=True
+            )
+            with concurrent.futures.ProcessPoolExecutor(self.jobs) as executor:
+                futures = {
+                    i: executor.submit(
+                        _break_paragraph, _plain_nodes(paragraphs[i]), lengths
+                    )
+                    for i in order
+                }
+                results = [futures[i].result() for i in range(len(paragraphs))]
+
         lines = []
-        for chapter in self.chapters:
-            lines.extend(self._process_chapter(chapter))
+        for chapter, nodes, (breaks, ratios) in zip(
+            self.chapters, paragraphs, results
+        ):
+            lines.extend(self._process_chapter(chapter, nodes, breaks, ratios))
 
         return lines
 
@@ -87,17 +123,14 @@ class Document:
 
         logger.info("Breaking lines into pages…")
 
-        npages = len(lines) // self.lines_per_page
-        if len(lines) % self.lines_per_page:
-            npages += 1
-
-        pages = [Page(self, [], 1)]
-        for i in range(npages):
-            page = Page(self, [], len(pages) + 1)
-            start = i * self.lines_per_page
-            end = min((i + 1) * self.lines_per_page, len(lines))
-            page.lines = lines[start:end]
-            pages.append(page)
+        # Every page has the same number of lines, except for the last one
+        # which gets what is left.
+        count = self.lines_per_page
+        starts = range(0, len(lines), count)
+        pages = [
+            Page(self, lines[start : start + count], number)
+            for number, start in enumerate(starts, 1)
+        ]
 
         return pages
 
@@ -106,30 +139,26 @@ class Document:
 
         return Heading(self, boxes)
 
-    def _process_chapter(self, chapter):
-        """Shapes the text and breaks it into lines."""
+    def _shape_chapter(self, chapter):
+        """Shapes the text of the chapter into nodes."""
 
-        logger.info("Chapter %d…", chapter.number)
-
-        lengths = [self.text_width]
         text = ""
         if chapter.opening:
             text = "بسمِ الله الرَحمنِ الرحيمِ؞ "
-        nodes = self.shaper.shape_paragraph(text + chapter.text)
-        breaks = nodes.compute_breakpoints(lengths, tolerance=4, looseness=10)
-        assert breaks[-1] == len(nodes) - 1
+        return self.shaper.shape_paragraph(text + chapter.text)
+
+    def _process_chapter(self, chapter, nodes, breaks, ratios):
+        """Creates the lines of the shaped and broken chapter text."""
+
+        logger.info("Chapter %d…", chapter.number)
 
         lines = [self._create_heading(chapter)]
 
         start = 0
-        for i, breakpoint in enumerate(breaks[1:]):
-            ratio = nodes.compute_adjustment_ratio(start, breakpoint, i, lengths)
-
-            boxes = []
-            for j in range(start, breakpoint):
-                box = nodes[j]
+        for breakpoint, ratio in zip(breaks[1:], ratios):
+            boxes = nodes[start:breakpoint]
+            for box in boxes:
                 box.ratio = ratio
-                boxes.append(box)
 
             lines.append(Line(self, boxes))
 
@@ -156,6 +185,27 @@ class Chapter:
         return text
 
 
+class _CharTable(dict):
+    """
+    Maps characters to "\x01" or "\x00", depending on whether they have some
+    Unicode property, for use with str.translate(). The table is filled as
+    the characters are first seen; the text uses few distinct characters, so
+    it stays small and after the first verses translate() does all the work.
+    """
+
+    def __init__(self, predicate):
+        super().__init__()
+        self.predicate = predicate
+
+    def __missing__(self, codepoint):
+        flag = self[codepoint] = "\x01" if self.predicate(chr(codepoint)) else "\x00"
+        return flag
+
+
+COMBINING = _CharTable(unicodedata.combining)
+LETTER = _CharTable(lambda ch: unicodedata.category(ch)[0] == "L")
+
+
 def _get_glyph(font, font_data, unicode, user_data):
     if unicode > GID_OFFSET:
         return unicode - GID_OFFSET
@@ -167,6 +217,7 @@ class Shaper:
 
     def __init__(self, doc):
         self.cache = {"hb": {}, "ft": {}}
+        self.verse_cache = {}
 
         self._font_funcs = hb.FontFuncs.create(True)
         self._font_funcs.set_nominal_glyph_func(_get_glyph, None, None)
@@ -178,10 +229,17 @@ class Shaper:
         self.font = self.make_font()
 
         self.buffer = hb.Buffer.create()
+        # clear_contents() resets the buffer language along with direction
+        # and script, so it has to be set for every text, but the language
+        # itself only needs to be looked up once.
+        self.language = hb.Language.from_string("ar")
 
         self.minfont, self.minaxis = self.make_var_font("ASHR")
         self.maxfont, self.maxaxis = self.make_var_font("ASTR")
 
+        # Advance widths of each glyph, see get_advances().
+        self.advances = {}
+
     def make_font(self, variations=None, funcs=None):
         cache = self.cache["hb"]
         key = f"{variations}:{funcs}"
@@ -202,6 +260,23 @@ class Shaper:
         font = self.make_font(f"{tag}={axis.max_value}")
         return font, axis
 
+    def get_advances(self, glyph):
+        """
+        Returns the advance widths of the glyph in the default, narrowest and
+        widest instances of the font. The font has a few hundred glyphs that
+        are used over and over, so the advances are only looked up once for
+        each glyph.
+        """
+
+        advances = self.advances.get(glyph)
+        if advances is None:
+            advances = self.advances[glyph] = (
+                self.font.get_glyph_h_advance(glyph),
+                self.minfont.get_glyph_h_advance(glyph),
+                self.maxfont.get_glyph_h_advance(glyph),
+            )
+        return advances
+
     def make_qahira_face(self, variations=None):
         cache = self.cache["ft"]
         if variations not in cache:
@@ -227,7 +302,7 @@ class Shaper:
         buf.clear_contents()
         buf.direction = direction
         buf.script = hb.HARFBUZZ.SCRIPT_ARABIC
-        buf.language = hb.Language.from_string("ar")
+        buf.language = self.language
 
         return buf
 
@@ -247,85 +322,120 @@ class Shaper:
 
         return buf.get_glyphs()[0]
 
-    @staticmethod
-    def next_is_nonjoining(text, infos, index):
-        if index < len(infos):
-            cluster = infos[index].cluster
-            category = unicodedata.category(text[cluster])
-            return category[0] != "L"
-        return True
-
     def shape_verse(self, verse, mark=None):
         """
-        Shapes a single verse and returns the corresponding nodes.
+        Shapes a single verse and returns the corresponding nodes. Verses that
+        recur are shaped only once; the nodes get their adjustment ratio set
+        when the lines are created, so each verse gets copies of them.
         """
 
+        nodes = self.verse_cache.get(verse)
+        if nodes is None:
+            nodes = self.verse_cache[verse] = self._shape_verse(verse)
+        nodes = [copy.copy(node) for node in nodes]
+
+        if mark:
+            buf = self.shape(mark, hb.HARFBUZZ.DIRECTION_LTR)
+            glyphs, pos = buf.get_glyphs()
+            nodes.append(Box(self.doc, mark, glyphs, pos.x))
+
+        return nodes
+
+    def _shape_verse(self, verse):
+        # Nothing to shape, e.g. the text after the last aya mark of a chapter.
+        if not verse:
+            return []
+
         buf = self.shape(verse, hb.HARFBUZZ.DIRECTION_RTL)
 
-        nodes = []
+        # Look up the Unicode properties of the verse characters once, instead
+        # of for every cluster below.
+        combining = verse.translate(COMBINING).encode("ascii")
+        letter = verse.translate(LETTER).encode("ascii")
+
+        # Copy the glyph data into flat lists once. The glyph positions make a
+        # new vector each time their advance or offset is read, so the raw
+        # fields are used instead.
         infos = buf.glyph_infos
         positions = buf.glyph_positions
-        flip = qh.Vector(1, -1)
-        i = len(infos) - 1
-        while i >= 0:
-            # Find all indices with same cluster
-            j = i
-            while j >= 0 and infos[i].cluster == infos[j].cluster:
-                j -= 1
-
-            # Collect all glyphs in this cluster, iterating backwards to get
-            # glyphs in the visual order.
-            pos = qh.Vector(0, 0)
-            glyphs = []
-            for k in reversed(range(i, j, -1)):
-                glyphs.append(
-                    qh.Glyph(infos[k].codepoint, pos + flip * positions[k].offset)
-                )
-                pos += flip * positions[k].advance
+        clusters = [info.cluster for info in infos]
+        codepoints = [info.codepoint for info in infos]
+        x_advances = [position.x_advance for position in positions]
+        y_advances = [position.y_advance for position in positions]
+        x_offsets = [position.x_offset for position in positions]
+        y_offsets = [position.y_offset for position in positions]
+
+        # Find where the clusters change in one pass. The glyphs are walked
+        # backwards, so each cluster runs from the previous index down to, but
+        # not including, the next one; the last one ends before the first glyph.
+        ends = [
+            k
+            for k in range(len(clusters) - 2, -1, -1)
+            if clusters[k] != clusters[k + 1]
+        ]
+        if clusters:
+            ends.append(-1)
 
+        nodes = []
+        i = len(clusters) - 1
+        for j in ends:
             # The chars in this cluster
-            chars = verse[infos[i].cluster : infos[j].cluster]
+            start, end = clusters[i], clusters[j]
+            chars = verse[start:end]
 
             # We skip space since the font kerns with it and we will turn these
             # kerns into glue below.
+            joining = False
+            kern_x = kern_y = 0
             if chars != " ":
                 # Find the last non-combining mark char in the string, to check
                 # for joining behaviour.
-                for ch in chars:
-                    if not unicodedata.combining(ch):
-                        base = ch
+                for c in range(end - 1, start - 1, -1):
+                    if not combining[c]:
+                        base = verse[c]
+                        break
 
-                adv = self.font.get_glyph_h_advance(glyphs[-1].index)
-                minadv = self.minfont.get_glyph_h_advance(glyphs[-1].index)
-                maxadv = self.maxfont.get_glyph_h_advance(glyphs[-1].index)
+                adv, minadv, maxadv = self.get_advances(codepoints[i])
 
                 shrink = adv - minadv
                 stretch = maxadv - adv
 
-                if base in RIGH_JOINING or self.next_is_nonjoining(verse, infos, j):
+                # The next cluster is not joining if it starts with a non-letter.
+                if base in RIGH_JOINING or not letter[clusters[j]]:
                     # Get the difference between the original advance width and
-                    # the advance width after OTL.
-                    kern = positions[k].advance - qh.Vector(adv, 0)
-
-                    # Re-adjust glyph positions.
-                    glyphs = [qh.Glyph(g.index, g.pos - kern) for g in glyphs]
-                    nodes.append(Box(self.doc, chars, glyphs, adv, stretch, shrink))
-
-                    # Add glue with the kerning amount with minimal stretch and shrink.
-                    nodes.append(Glue(self.doc, kern.x, kern.x / 8.5, kern.x / 8.5))
-                else:
-                    nodes.append(Box(self.doc, chars, glyphs, pos.x, stretch, shrink))
-            elif pos.x != 0:
+                    # the advance width after OTL, of the last glyph in the
+                    # visual order.
+                    joining = True
+                    kern_x, kern_y = x_advances[i] - adv, y_advances[i]
+
+            # Collect all glyphs in this cluster, iterating backwards to get
+            # glyphs in the visual order. The kern, if any, is known already,
+            # so the glyph positions are re-adjusted as they are collected.
+            # The pen position is kept as plain numbers, with y flipped, and
+            # only the glyph positions are made into vectors.
+            x = y = 0
+            glyphs = []
+            for k in reversed(range(i, j, -1)):
+                glyph_pos = qh.Vector(
+                    x + x_offsets[k] - kern_x, y - y_offsets[k] - kern_y
+                )
+                glyphs.append(qh.Glyph(codepoints[k], glyph_pos))
+                x += x_advances[k]
+                y -= y_advances[k]
+
+            if joining:
+                nodes.append(Box(self.doc, chars, glyphs, adv, stretch, shrink))
+
+                # Add glue with the kerning amount with minimal stretch and shrink.
+                nodes.append(Glue(self.doc, kern_x, kern_x / 8.5, kern_x / 8.5))
+            elif chars != " ":
+                nodes.append(Box(self.doc, chars, glyphs, x, stretch, shrink))
+            elif x != 0:
                 # If space is not zero-width, add glue for it.
-                nodes.append(Glue(self.doc, pos.x, pos.x / 8.5, pos.x / 8.5))
+                nodes.append(Glue(self.doc, x, x / 8.5, x / 8.5))
 
             i = j
 
-        if mark:
-            buf = self.shape(mark, hb.HARFBUZZ.DIRECTION_LTR)
-            glyphs, pos = buf.get_glyphs()
-            nodes.append(Box(self.doc, mark, glyphs, pos.x))
-
         return nodes
 
     def shape_paragraph(self, text):
@@ -335,26 +445,17 @@ class Shaper:
         """
         nodes = linebreak.NodeList()
 
-        # Split the text into verses, using aya mark as seperator.
-        verse = ""
-        text = text.strip()
-        textlen = len(text)
-        i = 0
-        while i < textlen:
-            ch = text[i]
-            if ch == "\u06DD":
-                mark = ch
-                i += 1
-                while i < textlen and text[i] in DIGITS:
-                    mark += text[i]
-                    i += 1
-                nodes.extend(self.shape_verse(verse, mark))
-                verse = ""
-            else:
-                verse += ch
-                i += 1
-
-        nodes.extend(self.shape_verse(verse))
+        # Split the text into verses, using aya mark as seperator. The mark is
+        # captured, so verses and marks alternate, ending with the text after
+        # the last mark. Marks are not white space, so stripping the first and
+        # last parts is the same as stripping the text, without copying it.
+        parts = AYA_MARK.split(text)
+        parts[0] = parts[0].lstrip()
+        parts[-1] = parts[-1].rstrip()
+        for verse, mark in zip(parts[::2], parts[1::2]):
+            nodes.extend(self.shape_verse(verse, mark))
+
+        nodes.extend(self.shape_verse(parts[-1]))
         nodes.add_closing_penalty()
 
         return nodes
@@ -363,6 +464,8 @@ class Shaper:
 class Page:
     """Class representing a page of text."""
 
+    __slots__ = ("doc", "lines", "number", "cr")
+
     def __init__(self, doc, lines, number):
         self.doc = doc
         self.lines = lines
@@ -388,16 +491,57 @@ class Page:
         cr.show_page()
 
 
+class GlyphRun:
+    """
+    Glyphs without colour layers, collected from consecutive boxes using the
+    same font instance, so that they can be drawn with a single show_glyphs()
+    call instead of one for each glyph.
+    """
+
+    __slots__ = ("cr", "shaper", "variations", "glyphs")
+
+    def __init__(self, cr, shaper):
+        self.cr = cr
+        self.shaper = shaper
+        self.variations = None
+        self.glyphs = []
+
+    def add(self, glyphs, variations=None):
+        if variations != self.variations:
+            self.flush()
+            self.variations = variations
+        self.glyphs.extend(glyphs)
+
+    def flush(self):
+        """Draws the collected glyphs, needed before drawing anything else."""
+
+        if not self.glyphs:
+            return
+
+        cr = self.cr
+        if self.variations:
+            cr.save()
+            cr.set_font_face(self.shaper.make_qahira_face(self.variations))
+            cr.show_glyphs(self.glyphs)
+            cr.restore()
+        else:
+            cr.show_glyphs(self.glyphs)
+        self.glyphs = []
+
+
 class Glue(linebreak.Glue):
+    __slots__ = ("doc",)
+
     def __init__(self, doc, width, stretch, shrink):
         super().__init__(width=width, stretch=stretch, shrink=shrink)
         self.doc = doc
 
-    def draw(self, cr, pos, drawColorLayers):
+    def draw(self, cr, pos, drawColorLayers, run):
         width = self.compute_width()
         x, y = pos.x - width, pos.y
 
         if self.doc.debug and width != self.width:
+            run.flush()
             cr.save()
             if self.ratio > 0:
                 cr.set_source_colour((0, 1, 0, 0.2))
@@ -411,35 +555,55 @@ class Glue(linebreak.Glue):
 
 
 class Box(linebreak.Box):
+    __slots__ = ("doc", "text", "glyphs")
+
     def __init__(self, doc, text, glyphs, width, stretch=0, shrink=0):
         super().__init__(width=width, stretch=stretch, shrink=shrink)
         self.doc = doc
         self.text = text
         self.glyphs = glyphs
 
-    def draw(self, cr, pos, drawColorLayers):
-        cr.save()
+    def draw(self, cr, pos, drawColorLayers, run):
+        """
+        Draws the glyphs with colour layers, or adds the glyphs without them to
+        the run, depending on drawColorLayers.
+        """
+
         glyphs = self.glyphs
         shaper = self.doc.shaper
         face = shaper.font.face
 
         width = self.compute_width()
         x, y = pos.x - width, pos.y
-        cr.translate((x, y))
 
+        variations = None
         if width != self.width:
             axis = shaper.maxaxis if self.ratio > 0 else shaper.minaxis
             value = abs(self.ratio) * (axis.max_value - axis.default_value)
             variations = f"{axis.tag}={value}"
 
             glyphs = shaper.reshape(glyphs, variations)
-            cr.set_font_face(shaper.make_qahira_face(variations))
 
-        colors = face.ot_colour_palette_get_colours(0)
+        if not drawColorLayers:
+            offset = qh.Vector(x, y)
+            run.add(
+                [
+                    qh.Glyph(glyph.index, glyph.pos + offset)
+                    for glyph in glyphs
+                    if not face.ot_colour_glyph_get_layers(glyph.index)
+                ],
+                variations,
+            )
+        else:
+            cr.save()
+            cr.translate((x, y))
+            if variations:
+                cr.set_font_face(shaper.make_qahira_face(variations))
+
+            colors = face.ot_colour_palette_get_colours(0)
 
-        for glyph in glyphs:
-            layers = face.ot_colour_glyph_get_layers(glyph.index)
-            if layers and drawColorLayers:
+            for glyph in glyphs:
+                layers = face.ot_colour_glyph_get_layers(glyph.index)
                 for layer in layers:
                     color = colors[layer.colour_index]
                     color = [
@@ -454,11 +618,10 @@ class Box(linebreak.Box):
                     cr.set_source_colour(color)
                     cr.show_glyphs([lglyph])
                     cr.restore()
-            elif not layers and not drawColorLayers:
-                cr.show_glyphs([glyph])
-        cr.restore()
+            cr.restore()
 
         if self.doc.debug and width != self.width:
+            run.flush()
             cr.save()
             if self.ratio > 0:
                 cr.set_source_colour((0, 1, 0, 0.2))
@@ -474,6 +637,8 @@ class Box(linebreak.Box):
 class Line:
     """Class representing a line of text."""
 
+    __slots__ = ("doc", "height", "boxes")
+
     def __init__(self, doc, boxes):
         self.doc = doc
         self.height = doc.leading
@@ -482,10 +647,12 @@ class Line:
     def draw(self, cr, pos):
         self.strip()
 
+        run = GlyphRun(cr, self.doc.shaper)
         for drawColorLayers in (False, True):
             p = qh.Vector(pos.x, pos.y)
             for box in self.boxes:
-                p.x = box.draw(cr, p, drawColorLayers)
+                p.x = box.draw(cr, p, drawColorLayers, run)
+            run.flush()
 
     def strip(self):
         while self.boxes and not self.boxes[-1].is_box:
@@ -495,6 +662,8 @@ class Line:
 class Heading(Line):
     """Class representing a chapter heading."""
 
+    __slots__ = ()
+
     def __init__(self, doc, boxes):
         super().__init__(doc, boxes)
 
@@ -505,6 +674,49 @@ class Heading(Line):
         cr.restore()
 
 
+def _plain_nodes(nodes):
+    """Returns a copy of the nodes made only of the base linebreak types."""
+
+    plain = linebreak.NodeList()
+    for node in nodes:
+        if node.is_box:
+            cls = linebreak.Box
+        elif node.is_glue:
+            cls = linebreak.Glue
+        else:
+            cls = linebreak.Penalty
+        plain.append(
+            cls(
+                width=node.width,
+                stretch=node.stretch,
+                shrink=node.shrink,
+                penalty=node.penalty,
+                flagged=node.flagged,
+            )
+        )
+    return plain
+
+
+def _break_paragraph(nodes, line_lengths):
+    """
+    Breaks the nodes of a chapter into lines, returning the breakpoints and
+    the adjustment ratio of each line.
+    """
+
+    breaks = nodes.compute_breakpoints(line_lengths, tolerance=4, looseness=10)
+    assert breaks[-1] == len(nodes) - 1
+
+    ratios = []
+    start = 0
+    for i, breakpoint in enumerate(breaks[1:]):
+        ratios.append(
+            nodes.compute_adjustment_ratio(start, breakpoint, i, line_lengths)
+        )
+        start = breakpoint + 1
+
+    return breaks, ratios
+
+
 def read_data(datadir):
     path = os.path.join(datadir, "meta.txt")
     if os.path.isfile(path):
@@ -534,8 +746,8 @@ def read_data(datadir):
     return chapters
 
 
-def main(chapters, filename, debug):
-    document = Document(chapters, filename, debug)
+def main(chapters, filename, debug, jobs=None):
+    document = Document(chapters, filename, debug, jobs)
     document.save()
 
 
@@ -562,6 +774,13 @@ if __name__ == "__main__":
     parser.add_argument(
         "--debug", "-d", action="store_true", help="Draw some debugging aids"
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        metavar="N",
+        type=int,
+        help="Number of processes for line breaking (Default: one per CPU)",
+    )
     parser.add_argument(
         "--quite", "-q", action="store_true", help="Don’t print normal messages"
     )
@@ -584,4 +803,4 @@ if __name__ == "__main__":
     for i in args.chapters:
         chapters.append(all_chapters[i])
 
-    main(chapters, args.outfile, args.debug)
+    main(chapters, args.outfile, args.debug, args.jobs)